@@ -8,6 +8,8 @@ class Settings:
     GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
     SPREADSHEET_ID = os.getenv("SPREADSHEET_ID")
     DATABASE_URL = os.getenv("DATABASE_URL")
+    PUBLIC_URL = os.getenv("PUBLIC_URL")
+    WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
 
 
 settings = Settings()
@@ -0,0 +1,98 @@
+from google.oauth2 import service_account
+from googleapiclient.discovery import build
+import hashlib
+import json
+import time
+import uuid
+
+WATCH_CHANNEL_FILE = "watch_channel.json"
+
+# Drive caps files.watch channels at one day
+CHANNEL_TTL = 24 * 60 * 60
+# renew the channel once it has less than this left
+RENEW_BEFORE = 2 * 60 * 60
+
+_drive = None
+
+
+def _get_drive():
+    """Build the Drive API client lazily from the service account"""
+    global _drive
+    if _drive is None:
+        credentials = service_account.Credentials.from_service_account_file(
+            "credentials.json",
+            scopes=["https://www.googleapis.com/auth/drive.readonly"],
+        )
+        _drive = build("drive", "v3", credentials=credentials, cache_discovery=False)
+    return _drive
+
+
+def load_watch_channel():
+    """Load the active push channel from file"""
+    try:
+        with open(WATCH_CHANNEL_FILE, "r") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def save_watch_channel(channel):
+    """Persist the active push channel so it can be renewed or stopped"""
+    with open(WATCH_CHANNEL_FILE, "w") as f:
+        json.dump(channel, f, indent=2)
+
+
+def ensure_sheet_watch(spreadsheet_id, address, token):
+    """
+    Make sure Drive pushes change notifications for the spreadsheet
+
+    Registers a new channel if none exists, its settings changed or it is
+    about to expire, then stops the old channel.
+
+    Args:
+        spreadsheet_id: Google Sheets ID
+        address: Public HTTPS URL Drive should POST notifications to
+        token: Shared secret Drive echoes back in X-Goog-Channel-Token
+    """
+    channel = load_watch_channel()
+    expires_at = channel.get("expiration", 0) / 1000
+    # only a digest of the token is persisted, to spot secret rotation
+    token_hash = hashlib.sha256(token.encode()).hexdigest()
+
+    if (
+        channel.get("file_id") == spreadsheet_id
+        and channel.get("address") == address
+        and channel.get("token_hash") == token_hash
+        and expires_at - time.time() > RENEW_BEFORE
+    ):
+        return
+
+    drive = _get_drive()
+    body = {
+        "id": str(uuid.uuid4()),
+        "type": "web_hook",
+        "address": address,
+        "token": token,
+        "expiration": int((time.time() + CHANNEL_TTL) * 1000),
+    }
+    response = drive.files().watch(fileId=spreadsheet_id, body=body).execute()
+
+    save_watch_channel(
+        {
+            "id": response["id"],
+            "resource_id": response["resourceId"],
+            "expiration": int(response.get("expiration", body["expiration"])),
+            "file_id": spreadsheet_id,
+            "address": address,
+            "token_hash": token_hash,
+        }
+    )
+    print(f"Registered Drive push channel {response['id']} for {spreadsheet_id}")
+
+    if channel.get("id"):
+        try:
+            drive.channels().stop(
+                body={"id": channel["id"], "resourceId": channel["resource_id"]}
+            ).execute()
+        except Exception as e:
+            print(f"Could not stop old push channel {channel['id']}: {e}")
@@ -1,56 +1,153 @@
-from fastapi import FastAPI, Request
+from fastapi import FastAPI, Request, Response
+from fastapi.concurrency import run_in_threadpool
 from fastapi_utils.tasks import repeat_every
 from config import settings
-import time
+import asyncio
+import hashlib
+import hmac
 
-from sync_utils import load_sync_state
+from sync_utils import claim_once, hold_lease
 from mysql_sync import sync_sheets_to_mysql
 from sheets_sync import sync_mysql_to_sheets
+from drive_watch import ensure_sheet_watch
 
 app = FastAPI()
 
+# seconds between periodic jobs
+MYSQL_TO_SHEETS_INTERVAL = 60
+WATCH_RENEW_INTERVAL = 60 * 60
+
+# upper bound on one sync; a lease older than this is considered abandoned
+SYNC_LEASE_TTL = 300
+
+# wait this long before syncing so a burst of edits folds into one sync
+SYNC_DEBOUNCE_SECONDS = 0.5
+
+# table name -> in-flight sheets → MySQL sync task
+_inflight = {}
+# tables edited again while their sync task was already running
+_dirty = set()
+
 
 @app.on_event("startup")
-@repeat_every(seconds=60)
+@repeat_every(seconds=MYSQL_TO_SHEETS_INTERVAL)
 async def periodic_mysql_to_sheets_sync():
-    """Automatically sync MySQL to Sheets every 30 seconds if there are changes"""
-    sync_mysql_to_sheets("Sync7", settings.SPREADSHEET_ID)
+    """Automatically sync MySQL to Sheets every minute if there are changes"""
+    # every uvicorn worker runs this loop - only the one that claims the
+    # current interval does the sync
+    if not claim_once("cron:mysql_to_sheets", MYSQL_TO_SHEETS_INTERVAL - 5):
+        return
+    await run_in_threadpool(_run_locked, sync_mysql_to_sheets, "Sync7")
+
+
+@app.on_event("startup")
+@repeat_every(seconds=WATCH_RENEW_INTERVAL)
+async def renew_sheet_watch():
+    """Register (and renew before expiry) the Drive push channel for the sheet"""
+    if not settings.PUBLIC_URL or not settings.WEBHOOK_SECRET:
+        return
+    if not claim_once("cron:renew_sheet_watch", WATCH_RENEW_INTERVAL - 60):
+        return
+    try:
+        # the Drive watch/stop calls block, keep them off the event loop
+        await run_in_threadpool(
+            ensure_sheet_watch,
+            settings.SPREADSHEET_ID,
+            settings.PUBLIC_URL.rstrip("/") + "/webhooks/sheets",
+            settings.WEBHOOK_SECRET,
+        )
+    except Exception as e:
+        print(f"Watch Error: {e}")
 
 
 @app.post("/webhooks/sheets")
 async def receive_sheet_update(request: Request):
     """Webhook endpoint triggered by Google Sheets changes"""
-    try:
-        # Check sync state to prevent race conditions
-        sync_state = load_sync_state()
-        last_state = sync_state.get("Sync", {})
-        current_time = time.time()
-        last_sync_time = last_state.get("last_sync", 0)
-        time_since_last_sync = current_time - last_sync_time
-
-        # If last sync was from sheets_sync and happened less than 5 seconds ago, skip
-        if (
-            last_state.get("direction") == "mysql_to_sheets"
-            and time_since_last_sync < 5
-        ):
-            print("Skipping webhook - recent mysql_to_sheets sync detected")
-            return {"status": "skipped", "reason": "recent_mysql_sync"}
-
-        # Perform the sync
-        result = sync_sheets_to_mysql("Sync7", settings.SPREADSHEET_ID)
-
-        return result
+    # Reject unauthenticated calls before touching sync state or MySQL
+    body = await request.body()
+    if not _is_authentic(request, body):
+        return Response(status_code=401)
+
+    # Drive push notifications: only content updates need a sync
+    resource_state = request.headers.get("X-Goog-Resource-State")
+    if resource_state is not None and resource_state != "update":
+        return {"status": "ignored", "reason": resource_state}
+
+    # Drop redelivered events - Drive numbers its messages per channel,
+    # Apps Script payloads carry a timestamp so their hash is unique per edit
+    channel_id = request.headers.get("X-Goog-Channel-Id")
+    if channel_id:
+        event_id = f"{channel_id}:{request.headers.get('X-Goog-Message-Number', '')}"
+    elif body:
+        event_id = hashlib.sha256(body).hexdigest()
+    else:
+        event_id = None
+
+    if event_id and not claim_once(f"webhook:{event_id}", 3600):
+        print(f"Skipping webhook - duplicate event {event_id}")
+        return {"status": "duplicate"}
 
+    # Acknowledge right away and sync in the background, so slow MySQL
+    # writes never push the webhook past the sender's timeout. Calls that
+    # arrive while a sync is pending piggy-back on it; there is no await
+    # between the check and the assignment, so no lock is needed.
+    table_name = "Sync7"
+    task = _inflight.get(table_name)
+    if task is not None and not task.done():
+        _dirty.add(table_name)
+        return {"status": "coalesced"}
+
+    _inflight[table_name] = asyncio.create_task(_coalesced_sync(table_name))
+    return {"status": "queued"}
+
+
+async def _coalesced_sync(table_name):
+    """Sync Sheets → MySQL for a table until no new edits arrived meanwhile"""
+    try:
+        while True:
+            await asyncio.sleep(SYNC_DEBOUNCE_SECONDS)
+            _dirty.discard(table_name)
+            await run_in_threadpool(_run_locked, sync_sheets_to_mysql, table_name)
+            if table_name not in _dirty:
+                break
     except Exception as e:
         print(f"Sync Error: {e}")
-        return {"status": "error", "message": str(e)}
+    finally:
+        _inflight.pop(table_name, None)
+
+
+def _run_locked(sync_function, table_name):
+    """Run a sync in a worker thread while holding the table's lease"""
+    # the lease lives in the shared SQLite state database, so both sync
+    # directions are serialized across threads and uvicorn worker processes
+    with hold_lease(f"sync:{table_name}", SYNC_LEASE_TTL):
+        return sync_function(table_name, settings.SPREADSHEET_ID)
+
+
+def _is_authentic(request, body):
+    """
+    Check a webhook call against WEBHOOK_SECRET in constant time
+
+    Drive push notifications echo the secret as the channel token, Apps
+    Script calls sign the body with HMAC-SHA256 in X-Signature.
+    """
+    if not settings.WEBHOOK_SECRET:
+        return False
+    secret = settings.WEBHOOK_SECRET.encode()
+
+    if request.headers.get("X-Goog-Channel-Id"):
+        token = request.headers.get("X-Goog-Channel-Token", "").encode()
+        return hmac.compare_digest(token, secret)
+
+    mac = hmac.new(secret, body, hashlib.sha256).hexdigest().encode()
+    return hmac.compare_digest(mac, request.headers.get("X-Signature", "").encode())
 
 
 @app.post("/webhooks/mysql-to-sheets/{table_name}")
 async def trigger_mysql_to_sheets(table_name: str):
     """Manual endpoint to trigger MySQL → Sheets sync"""
     try:
-        sync_mysql_to_sheets(table_name, settings.SPREADSHEET_ID)
+        await run_in_threadpool(_run_locked, sync_mysql_to_sheets, table_name)
         return {"status": "success", "table": table_name}
     except Exception as e:
         return {"status": "error", "message": str(e)}
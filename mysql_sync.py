@@ -1,12 +1,30 @@
-import gspread
-from sqlalchemy import create_engine, inspect, text
+import functools
+from gspread.exceptions import APIError
+from sqlalchemy import create_engine, text
 from config import settings
 import time
 
-from sync_utils import save_sync_state, get_data_hash, get_column_letter
+from sync_utils import (
+    get_spreadsheet,
+    get_worksheet,
+    invalidate_sheet_handles,
+    load_sync_state,
+    save_sync_state,
+    get_data_hash,
+    get_row_hashes,
+    get_column_letters,
+    load_row_hashes,
+    save_row_hashes,
+)
 
 engine = create_engine(settings.DATABASE_URL)
-gc = gspread.service_account(filename="credentials.json")
+
+# rows per INSERT statement
+UPSERT_CHUNK_SIZE = 500
+
+# table name -> set of column names, filled on first sync and kept in step
+# with our own DDL so repeated syncs skip schema discovery entirely
+_schema_cache = {}
 
 
 def sync_sheets_to_mysql(table_name, spreadsheet_id):
@@ -23,27 +41,62 @@ def sync_sheets_to_mysql(table_name, spreadsheet_id):
     print(f"Starting Sheets → MySQL sync for {table_name}...")
 
     try:
-        sh = gc.open_by_key(spreadsheet_id)
-        worksheet = sh.get_worksheet(0)
-        all_values = worksheet.get_all_values()
+        sh = get_spreadsheet(spreadsheet_id)
+        # one values.batchGet call over the whole first worksheet (the same
+        # tab MySQL → Sheets writes to), addressed by its cached title
+        title = get_worksheet(spreadsheet_id).title.replace("'", "''")
+        response = sh.values_batch_get(
+            ranges=[f"'{title}'"], params={"valueRenderOption": "FORMATTED_VALUE"}
+        )
+        values = response["valueRanges"][0].get("values", [])
+
+        # the API trims trailing empty cells - pad rows like get_all_values()
+        width = max((len(row) for row in values), default=0)
+        all_values = [row + [""] * (width - len(row)) for row in values]
 
         if not all_values:
             print("No data in sheet")
             return {"status": "ignored", "reason": "no_data"}
     except Exception as e:
         print(f"Error reading Google Sheet: {e}")
+        # the range uses the cached worksheet title, which is stale if the
+        # tab was renamed - reopen the handles on any API error
+        if isinstance(e, APIError):
+            invalidate_sheet_handles()
         return {"status": "error", "message": str(e)}
 
+    # skip echoes of our own MySQL → Sheets writes and unchanged sheets
+    sheet_hash = get_data_hash(all_values)
+    last_state = load_sync_state(table_name)
+    if last_state.get("sheet_hash") == sheet_hash:
+        print("No changes detected in sheet data")
+        return {"status": "skipped", "reason": "no_changes"}
+
     max_cols = max(len(row) for row in all_values)
-    col_names = [get_column_letter(i + 1) for i in range(max_cols)]
+    col_names = get_column_letters(max_cols)
+    row_hashes = get_row_hashes(all_values)
 
     # Perform the sync
     try:
-        _sync_to_mysql_raw(table_name, col_names, all_values)
+        try:
+            _sync_to_mysql_raw(
+                table_name,
+                col_names,
+                all_values,
+                row_hashes,
+                load_row_hashes(table_name),
+            )
+        except Exception as e:
+            # the cached schema may be stale after DDL from outside this
+            # process (e.g. the Streamlit editor) - refresh it and retry once,
+            # rewriting every row
+            print(f"Retrying with a fresh schema after error: {e}")
+            _invalidate_schema(table_name)
+            _sync_to_mysql_raw(table_name, col_names, all_values, row_hashes, [])
 
         # save sync state
-        sheet_hash = get_data_hash(all_values)
         save_sync_state(table_name, "", sheet_hash, time.time(), "sheets_to_mysql")
+        save_row_hashes(table_name, row_hashes)
 
         print(f"Sheets → MySQL sync complete for {table_name}")
         return {"status": "success", "rows": len(all_values)}
@@ -53,41 +106,82 @@ def sync_sheets_to_mysql(table_name, spreadsheet_id):
         return {"status": "error", "message": str(e)}
 
 
-def _sync_to_mysql_raw(table_name, col_names, all_values):
-    """Internal function to perform the actual MySQL sync"""
-    inspector = inspect(engine)
+def _sync_to_mysql_raw(table_name, col_names, all_values, row_hashes, old_row_hashes):
+    """
+    Internal function to perform the actual MySQL sync
 
-    # create table if it doesn't exist
-    if not inspector.has_table(table_name):
-        with engine.begin() as conn:
-            conn.execute(text(f"CREATE TABLE `{table_name}` (`id` INT PRIMARY KEY)"))
-            print(f"Created table {table_name}")
+    Only rows whose hash differs from old_row_hashes (the previous sync) are
+    upserted, unless the schema or row count shows MySQL drifted from it.
+    """
+    schema_changed = False
 
-    # remove auto-increment from id column if exists
-    with engine.begin() as conn:
-        try:
-            result = conn.execute(text(f"SHOW CREATE TABLE `{table_name}`"))
-            create_statement = result.fetchone()[1]
+    if table_name not in _schema_cache:
+        # one round-trip tells whether the table exists, which columns it
+        # has and whether id is AUTO_INCREMENT
+        with engine.begin() as conn:
+            columns = conn.execute(
+                text("""
+                    SELECT COLUMN_NAME, EXTRA FROM information_schema.columns
+                    WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = :table_name
+                """),
+                {"table_name": table_name},
+            ).fetchall()
 
-            if "AUTO_INCREMENT" in create_statement.upper():
-                print("🔧 Removing AUTO_INCREMENT from id column...")
+        # create table if it doesn't exist
+        if not columns:
+            with engine.begin() as conn:
                 conn.execute(
-                    text(f"ALTER TABLE `{table_name}` MODIFY COLUMN `id` INT NOT NULL")
+                    text(f"CREATE TABLE `{table_name}` (`id` INT PRIMARY KEY)")
                 )
-                print("id column is now a regular integer")
-        except Exception as e:
-            print(f"Could not modify id column: {e}")
+                print(f"Created table {table_name}")
+            columns = [("id", "")]
+            schema_changed = True
+
+        # remove auto-increment from id column if exists
+        extras = {name: (extra or "").lower() for name, extra in columns}
+        if "auto_increment" in extras.get("id", ""):
+            with engine.begin() as conn:
+                try:
+                    print("🔧 Removing AUTO_INCREMENT from id column...")
+                    conn.execute(
+                        text(
+                            f"ALTER TABLE `{table_name}` MODIFY COLUMN `id` INT NOT NULL"
+                        )
+                    )
+                    print("id column is now a regular integer")
+                except Exception as e:
+                    print(f"Could not modify id column: {e}")
+
+        _schema_cache[table_name] = set(extras)
 
     # add missing columns
-    existing_cols = [c["name"] for c in inspector.get_columns(table_name)]
+    existing_cols = _schema_cache[table_name]
+    missing_cols = [c for c in col_names if c not in existing_cols]
 
-    with engine.begin() as conn:
-        for col in col_names:
-            if col not in existing_cols:
-                print(f"Adding column: {col}")
-                conn.execute(
-                    text(f"ALTER TABLE `{table_name}` ADD COLUMN `{col}` TEXT")
-                )
+    if missing_cols:
+        # one ALTER so MySQL rebuilds the table once, not once per column
+        print(f"Adding columns: {', '.join(missing_cols)}")
+        add_str = ", ".join([f"ADD COLUMN `{col}` TEXT" for col in missing_cols])
+        with engine.begin() as conn:
+            conn.execute(text(f"ALTER TABLE `{table_name}` {add_str}"))
+        existing_cols.update(missing_cols)
+        schema_changed = True
+
+    # rows whose hash matches the last sync are already in MySQL as-is
+    changed_rows = range(len(all_values))
+    if old_row_hashes and not schema_changed:
+        with engine.begin() as conn:
+            db_row_count = conn.execute(
+                text(f"SELECT COUNT(*) FROM `{table_name}`")
+            ).scalar()
+
+        # rows deleted or added outside this sync - rewrite everything
+        if db_row_count == len(old_row_hashes):
+            changed_rows = [
+                idx
+                for idx, row_hash in enumerate(row_hashes)
+                if idx >= len(old_row_hashes) or row_hash != old_row_hashes[idx]
+            ]
 
     # delete unused rows (rows beyond sheet data)
     total_sheet_rows = len(all_values)
@@ -101,36 +195,67 @@ def _sync_to_mysql_raw(table_name, col_names, all_values):
         if deleted_count > 0:
             print(f"Deleted {deleted_count} unused rows from database")
 
-    # upsert data - sync all columns for each row
+    # upsert data - batch rows into multi-VALUES statements
+    cols_to_use = ("id", *col_names)
+
+    # keep each statement under MySQL's 65535 placeholder limit
+    chunk_size = max(1, min(UPSERT_CHUNK_SIZE, 65535 // len(cols_to_use)))
+
     with engine.begin() as conn:
-        for idx, row in enumerate(all_values):
-            row_id = idx + 1
+        for start in range(0, len(changed_rows), chunk_size):
+            chunk = changed_rows[start : start + chunk_size]
+            sql, param_names = _upsert_statement(table_name, cols_to_use, len(chunk))
 
-            # Pad the row with empty strings if shorter than max columns
-            padded_row = row + [""] * (len(col_names) - len(row))
+            # Build parameters - use None for cleared cells and short rows
+            params = {}
+            for names, idx in zip(param_names, chunk):
+                row = all_values[idx]
+                params[names[0]] = idx + 1
+                for name, value in zip(names[1:], row):
+                    params[name] = value if value else None
+                for name in names[len(row) + 1 :]:
+                    params[name] = None
 
-            cols_to_use = ["id"] + col_names
+            conn.execute(sql, params)
 
-            col_str = ", ".join([f"`{c}`" for c in cols_to_use])
-            placeholders = ", ".join([f":{c}" for c in cols_to_use])
+    print(
+        f"Sync Complete for {table_name}. Total rows: {len(all_values)}, "
+        f"upserted: {len(changed_rows)}"
+    )
 
-            # Update all columns except id on duplicate
-            update_str = ", ".join(
-                [f"`{c}`=VALUES(`{c}`)" for c in cols_to_use if c != "id"]
-            )
 
-            sql = text(f"""
-                INSERT INTO `{table_name}` ({col_str}) 
-                VALUES ({placeholders}) 
-                ON DUPLICATE KEY UPDATE {update_str}
-            """)
+@functools.lru_cache(maxsize=32)
+def _upsert_statement(table_name, cols_to_use, num_rows):
+    """
+    Build the multi-VALUES upsert for num_rows rows, cached across syncs
 
-            # Build parameters - use None for cleared cells
-            params = {"id": row_id}
-            for i, col in enumerate(col_names):
-                value = padded_row[i] if padded_row[i] else None
-                params[col] = value
+    Args:
+        table_name: Name of the MySQL table
+        cols_to_use: Tuple of column names, starting with "id"
+        num_rows: Number of rows in the VALUES list
+
+    Returns:
+        tuple: (text() statement, list of parameter names for each row)
+    """
+    col_str = ", ".join([f"`{c}`" for c in cols_to_use])
+
+    # Update all columns except id on duplicate, reading the new values
+    # through the row alias (MySQL 8.0.19+) instead of deprecated VALUES()
+    update_str = ", ".join([f"`{c}`=new.`{c}`" for c in cols_to_use if c != "id"])
+
+    param_names = [[f"{c}_{i}" for c in cols_to_use] for i in range(num_rows)]
+    values_str = ", ".join(
+        "(" + ", ".join([f":{name}" for name in names]) + ")" for names in param_names
+    )
+
+    sql = text(f"""
+        INSERT INTO `{table_name}` ({col_str}) 
+        VALUES {values_str} AS new
+        ON DUPLICATE KEY UPDATE {update_str}
+    """)
+    return sql, param_names
 
-            conn.execute(sql, params)
 
-    print(f"Sync Complete for {table_name}. Total rows: {len(all_values)}")
+def _invalidate_schema(table_name):
+    """Forget cached schema details so the next sync inspects the table again"""
+    _schema_cache.pop(table_name, None)
@@ -1,17 +1,26 @@
-import gspread
-from sqlalchemy import create_engine, inspect, text
+from gspread.exceptions import APIError
+import pandas as pd
+from sqlalchemy import create_engine, text
 from config import settings
+import hashlib
 import time
 
 from sync_utils import (
+    drop_stale_sheet_handles,
+    get_worksheet,
+    invalidate_sheet_handles,
     load_sync_state,
+    save_row_hashes,
     save_sync_state,
     get_data_hash,
     get_column_letter,
 )
 
 engine = create_engine(settings.DATABASE_URL)
-gc = gspread.service_account(filename="credentials.json")
+
+# table name -> column names used by the change probe, refreshed whenever the
+# probe reports that the table's columns changed
+_column_cache = {}
 
 
 def sync_mysql_to_sheets(table_name, spreadsheet_id):
@@ -24,44 +33,66 @@ def sync_mysql_to_sheets(table_name, spreadsheet_id):
     """
     print(f"Starting MySQL → Sheets sync for {table_name}...")
 
-    inspector = inspect(engine)
+    # cheap change probe - skip the full fetch if the table is unchanged
+    last_state = load_sync_state(table_name)
+
+    try:
+        db_signature = _get_db_signature(table_name)
+    except Exception as e:
+        print(f"Could not compute table signature: {e}")
+        _column_cache.pop(table_name, None)
+        db_signature = None
+    else:
+        if db_signature is None:
+            print(f"Table {table_name} does not exist in MySQL")
+            return
 
-    if not inspector.has_table(table_name):
-        print(f"Table {table_name} does not exist in MySQL")
+    if db_signature and last_state.get("db_signature") == db_signature:
+        print("No changes detected in MySQL data")
         return
 
     try:
-        with engine.begin() as conn:
+        # stream rows through a server-side cursor and build sheet rows
+        # (excluding the 'id' column) as they arrive
+        with engine.connect().execution_options(
+            stream_results=True, max_row_buffer=1000
+        ) as conn:
             result = conn.execute(
                 text(f"SELECT * FROM `{table_name}` ORDER BY `id` ASC")
             )
-            rows = result.fetchall()
-            columns = result.keys()
+            columns = list(result.keys())
+            letter_columns = [col for col in columns if col != "id"]
+
+            # convert each streamed partition in one vectorized pass - None
+            # becomes an empty string, everything else its str() value
+            sheet_data = []
+            for partition in result.partitions(1000):
+                df = pd.DataFrame(partition, columns=columns, dtype=object)
+                df = df[letter_columns]
+
+                # astype(str) decodes bytes instead of calling str() on them,
+                # so BLOB/BINARY columns (one type per column) are mapped first
+                binary_cols = [
+                    col
+                    for col in letter_columns
+                    if (idx := df[col].first_valid_index()) is not None
+                    and isinstance(df[col].at[idx], (bytes, bytearray))
+                ]
+
+                df = df.where(df.notna(), "")
+                if binary_cols:
+                    df[binary_cols] = df[binary_cols].map(str)
+                sheet_data.extend(df.astype(str).values.tolist())
     except Exception as e:
         print(f"Error reading from MySQL: {e}")
         return
 
-    if not rows:
+    if not sheet_data:
         print(f"No data in table {table_name}")
         return
 
-    # prepare data for sheets (exclude 'id' column)
-    letter_columns = [col for col in columns if col != "id"]
-
-    sheet_data = []
-    for row in rows:
-        row_dict = dict(row._mapping)
-        sheet_row = []
-        for col in letter_columns:
-            value = row_dict.get(col, "")
-            # Convert None to empty string
-            sheet_row.append("" if value is None else str(value))
-        sheet_data.append(sheet_row)
-
     # check if data has changed
     current_db_hash = get_data_hash(sheet_data)
-    sync_state = load_sync_state()
-    last_state = sync_state.get(table_name, {})
 
     current_time = time.time()
     last_sync_time = last_state.get("last_sync", 0)
@@ -76,49 +107,213 @@ def sync_mysql_to_sheets(table_name, spreadsheet_id):
 
     if last_state.get("db_hash") == current_db_hash:
         print("No changes detected in MySQL data")
+        # remember the signature so the next idle tick short-circuits again
+        if db_signature and last_state.get("db_signature") != db_signature:
+            save_sync_state(
+                table_name,
+                last_state["db_hash"],
+                last_state.get("sheet_hash"),
+                last_state.get("last_sync"),
+                last_state.get("direction"),
+                db_signature,
+            )
         return
 
     try:
-        sh = gc.open_by_key(spreadsheet_id)
-        worksheet = sh.get_worksheet(0)
+        worksheet = get_worksheet(spreadsheet_id)
     except Exception as e:
         print(f"❌ Error opening Google Sheet: {e}")
+        drop_stale_sheet_handles(e)
         return
 
-    current_sheet_data = worksheet.get_all_values()
-    current_sheet_hash = get_data_hash(current_sheet_data)
+    try:
+        current_sheet_data = worksheet.get_all_values()
+        current_sheet_hash = get_data_hash(current_sheet_data)
 
-    if (
-        last_state.get("sheet_hash")
-        and last_state.get("sheet_hash") != current_sheet_hash
-    ):
-        print(
-            "⚠️ Sheet was modified externally - proceeding with MySQL data as source of truth"
-        )
+        if (
+            last_state.get("sheet_hash")
+            and last_state.get("sheet_hash") != current_sheet_hash
+        ):
+            print(
+                "⚠️ Sheet was modified externally - proceeding with MySQL data as source of truth"
+            )
 
-    try:
-        # Clear the entire sheet first
-        worksheet.clear()
+        # Write only the cells that differ from what the sheet already holds
+        updates = _diff_ranges(current_sheet_data, sheet_data)
 
-        if sheet_data:
-            # Determine the range (e.g., A1:F10)
+        if updates:
             num_rows = len(sheet_data)
             num_cols = len(letter_columns)
-            end_col_letter = get_column_letter(num_cols)
-            range_notation = f"A1:{end_col_letter}{num_rows}"
+            if num_rows > worksheet.row_count:
+                worksheet.add_rows(num_rows - worksheet.row_count)
+            if num_cols > worksheet.col_count:
+                worksheet.add_cols(num_cols - worksheet.col_count)
 
-            worksheet.update(range_notation, sheet_data)
-            print(f"Updated {num_rows} rows and {num_cols} columns to Google Sheets")
+            # the sheet is about to hold MySQL's values, so the row hashes
+            # saved by the last Sheets → MySQL sync no longer describe it -
+            # drop them so the next webhook upserts every row
+            save_row_hashes(table_name, [])
+            worksheet.batch_update(updates)
+            print(f"Updated {len(updates)} ranges in Google Sheets")
         else:
-            print("No data to sync")
+            print("Sheet already matches MySQL data")
 
         # update sync state
         new_sheet_hash = get_data_hash(sheet_data)
         save_sync_state(
-            table_name, current_db_hash, new_sheet_hash, current_time, "mysql_to_sheets"
+            table_name,
+            current_db_hash,
+            new_sheet_hash,
+            current_time,
+            "mysql_to_sheets",
+            db_signature,
         )
 
         print(f"MySQL → Sheets sync complete for {table_name}")
 
     except Exception as e:
         print(f"Error updating Google Sheet: {e}")
+        # the cached worksheet's row/col counts may be stale (e.g. rows were
+        # deleted in the sheet) - reopen it so the next tick resizes correctly
+        if isinstance(e, APIError):
+            invalidate_sheet_handles()
+
+
+def _get_db_signature(table_name):
+    """
+    Return a cheap "row count:checksum" signature of the table contents
+
+    Once the column list is cached this is a single round-trip: the same
+    statement fingerprints the table's columns, and a changed fingerprint or
+    a failing probe refreshes the cache and probes again.
+
+    Returns:
+        str: The signature, or None if the table does not exist
+    """
+    columns = _column_cache.get(table_name)
+    cached = columns is not None
+    if not cached:
+        with engine.begin() as conn:
+            columns = [
+                name
+                for (name,) in conn.execute(
+                    text("""
+                        SELECT COLUMN_NAME FROM information_schema.columns
+                        WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = :table_name
+                        ORDER BY ORDINAL_POSITION
+                    """),
+                    {"table_name": table_name},
+                )
+            ]
+        if not columns:
+            return None
+        _column_cache[table_name] = columns
+
+    # XOR-ing CRC32s lets equal edits on an even number of rows cancel out
+    # (CRC is linear), so each row and column name is folded in as the first
+    # 64 bits of its MD5 instead
+    row_str = ", ".join([f"IFNULL(`{c}`, '')" for c in columns])
+    digest = "CAST(CONV(LEFT(MD5({}), 16), 16, 10) AS UNSIGNED)"
+    row_digest = digest.format(f"CONCAT_WS(0x1f, {row_str})")
+    name_digest = digest.format("COLUMN_NAME")
+    try:
+        with engine.begin() as conn:
+            count, checksum, column_fingerprint = conn.execute(
+                text(f"""
+                    SELECT
+                        COUNT(*),
+                        COALESCE(BIT_XOR({row_digest}), 0),
+                        (
+                            SELECT CONCAT(COUNT(*), ':', BIT_XOR({name_digest}))
+                            FROM information_schema.columns
+                            WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = :table_name
+                        )
+                    FROM `{table_name}`
+                """),
+                {"table_name": table_name},
+            ).fetchone()
+    except Exception:
+        if not cached:
+            raise
+        # a cached column may have been dropped (e.g. by the Streamlit
+        # editor) - reload the column list and probe once more
+        _column_cache.pop(table_name, None)
+        return _get_db_signature(table_name)
+
+    if cached and column_fingerprint != _column_fingerprint(columns):
+        # columns were added or dropped since they were cached
+        _column_cache.pop(table_name, None)
+        return _get_db_signature(table_name)
+
+    return f"{count}:{checksum}"
+
+
+def _column_fingerprint(columns):
+    """Match the "count:BIT_XOR(MD5 prefix of name)" fingerprint computed in MySQL"""
+    checksum = 0
+    for name in columns:
+        checksum ^= int(hashlib.md5(name.encode()).hexdigest()[:16], 16)
+    return f"{len(columns)}:{checksum}"
+
+
+def _diff_ranges(old_data, new_data):
+    """
+    Build batch_update ranges covering only the cells that changed
+
+    Changed cells are grouped into runs per row, and identical runs on
+    consecutive rows are merged into a single block.
+
+    Args:
+        old_data: Current sheet values (list of rows)
+        new_data: Desired sheet values (list of rows)
+
+    Returns:
+        list: [{"range": "A5:C7", "values": [[...], ...]}, ...]
+    """
+    num_rows = max(len(old_data), len(new_data))
+    num_cols = max([len(row) for row in old_data + new_data], default=0)
+
+    blocks = []
+    prev_blocks = {}
+    for r in range(num_rows):
+        old_row = old_data[r] if r < len(old_data) else []
+        new_row = new_data[r] if r < len(new_data) else []
+        old_row = old_row + [""] * (num_cols - len(old_row))
+        new_row = new_row + [""] * (num_cols - len(new_row))
+
+        row_blocks = {}
+        c = 0
+        while c < num_cols:
+            if old_row[c] == new_row[c]:
+                c += 1
+                continue
+            start = c
+            while c < num_cols and old_row[c] != new_row[c]:
+                c += 1
+
+            block = prev_blocks.get((start, c))
+            if block is None:
+                block = {
+                    "start_row": r,
+                    "start_col": start,
+                    "end_col": c,
+                    "values": [],
+                }
+                blocks.append(block)
+            block["values"].append(new_row[start:c])
+            row_blocks[(start, c)] = block
+        prev_blocks = row_blocks
+
+    updates = []
+    for block in blocks:
+        start_col = get_column_letter(block["start_col"] + 1)
+        end_col = get_column_letter(block["end_col"])
+        start_row = block["start_row"] + 1
+        end_row = block["start_row"] + len(block["values"])
+        updates.append(
+            {
+                "range": f"{start_col}{start_row}:{end_col}{end_row}",
+                "values": block["values"],
+            }
+        )
+    return updates
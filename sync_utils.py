@@ -1,11 +1,35 @@
-import json
+import contextlib
+import functools
+import gspread
 import hashlib
+import sqlite3
+import threading
+import time
+import uuid
+from requests.adapters import HTTPAdapter
 
-SYNC_STATE_FILE = "sync_state.json"
+SYNC_STATE_DB = "sync_state.db"
+
+# bytes per row digest stored for row-level change detection
+ROW_HASH_SIZE = 8
+
+# seconds before cached Spreadsheet/Worksheet handles are refreshed
+SHEET_HANDLE_TTL = 300
+
+_db = None
+_db_lock = threading.Lock()
+
+
+_LETTERS = [chr(65 + i) for i in range(26)]
+# A..ZZ, covers every column a sync normally touches
+_COLUMN_LETTERS = _LETTERS + [a + b for a in _LETTERS for b in _LETTERS]
 
 
 def get_column_letter(n):
     """Convert column number to letter (1->A, 2->B, etc.)"""
+    if 0 < n <= len(_COLUMN_LETTERS):
+        return _COLUMN_LETTERS[n - 1]
+
     result = ""
     while n > 0:
         n, remainder = divmod(n - 1, 26)
@@ -13,16 +37,177 @@ def get_column_letter(n):
     return result
 
 
-def load_sync_state():
-    """Load the last sync state from file"""
+def get_column_letters(n):
+    """Return the letters of the first n columns (A, B, ... )"""
+    if n <= len(_COLUMN_LETTERS):
+        return _COLUMN_LETTERS[:n]
+    return _COLUMN_LETTERS + [
+        get_column_letter(i + 1) for i in range(len(_COLUMN_LETTERS), n)
+    ]
+
+
+@functools.lru_cache(maxsize=1)
+def get_sheets_client():
+    """Create the shared gspread client, reusing pooled HTTPS connections"""
+    gc = gspread.service_account(filename="credentials.json")
+    gc.http_client.session.mount(
+        "https://", HTTPAdapter(pool_connections=8, pool_maxsize=32)
+    )
+    return gc
+
+
+def get_spreadsheet(spreadsheet_id):
+    """Return a cached Spreadsheet handle, refreshed every SHEET_HANDLE_TTL"""
+    return _open_spreadsheet(spreadsheet_id, int(time.time() // SHEET_HANDLE_TTL))
+
+
+def get_worksheet(spreadsheet_id, index=0):
+    """Return a cached Worksheet handle, refreshed every SHEET_HANDLE_TTL"""
+    return _open_worksheet(spreadsheet_id, index, int(time.time() // SHEET_HANDLE_TTL))
+
+
+def drop_stale_sheet_handles(error):
+    """Clear the cached handles if error means they are no longer valid"""
+    response = getattr(error, "response", None)
+    if getattr(response, "status_code", None) in (401, 404):
+        invalidate_sheet_handles()
+
+
+def invalidate_sheet_handles():
+    """Clear the cached handles so the next call reopens the spreadsheet"""
+    _open_spreadsheet.cache_clear()
+    _open_worksheet.cache_clear()
+
+
+@functools.lru_cache(maxsize=8)
+def _open_spreadsheet(spreadsheet_id, ttl_bucket):
+    return get_sheets_client().open_by_key(spreadsheet_id)
+
+
+@functools.lru_cache(maxsize=8)
+def _open_worksheet(spreadsheet_id, index, ttl_bucket):
+    return get_spreadsheet(spreadsheet_id).get_worksheet(index)
+
+
+def _get_db():
+    """Open the shared SQLite state database (caller must hold _db_lock)"""
+    global _db
+    if _db is None:
+        _db = sqlite3.connect(
+            SYNC_STATE_DB, check_same_thread=False, isolation_level=None
+        )
+        _db.execute("PRAGMA journal_mode=WAL")
+        _db.execute(
+            "CREATE TABLE IF NOT EXISTS claimed_keys "
+            "(key TEXT PRIMARY KEY, expires_at REAL NOT NULL)"
+        )
+        _db.execute(
+            "CREATE TABLE IF NOT EXISTS sync_state ("
+            "table_name TEXT PRIMARY KEY, db_hash TEXT, sheet_hash TEXT, "
+            "last_sync REAL, direction TEXT, db_signature TEXT)"
+        )
+        _db.execute(
+            "CREATE TABLE IF NOT EXISTS leases "
+            "(key TEXT PRIMARY KEY, owner TEXT NOT NULL, expires_at REAL NOT NULL)"
+        )
+        _db.execute(
+            "CREATE TABLE IF NOT EXISTS row_hashes "
+            "(table_name TEXT PRIMARY KEY, hashes BLOB)"
+        )
+    return _db
+
+
+def claim_once(key, ttl):
+    """
+    Atomically claim a key for ttl seconds
+
+    Args:
+        key: Idempotency key, e.g. a webhook event id
+        ttl: Seconds before the key can be claimed again
+
+    Returns:
+        bool: True if this call claimed the key, False if it was already taken
+    """
+    now = time.time()
+    with _db_lock:
+        db = _get_db()
+        db.execute("DELETE FROM claimed_keys WHERE expires_at <= ?", (now,))
+        cursor = db.execute(
+            "INSERT OR IGNORE INTO claimed_keys (key, expires_at) VALUES (?, ?)",
+            (key, now + ttl),
+        )
+        return cursor.rowcount == 1
+
+
+@contextlib.contextmanager
+def hold_lease(key, ttl, poll_interval=0.1):
+    """
+    Hold an exclusive lease on key, shared by every thread and process
+    using the same state database
+
+    Blocks until the lease is free. A lease left behind by a crashed
+    process expires after ttl seconds, so ttl must outlast the work done
+    while holding it.
+
+    Args:
+        key: Name of the lease, e.g. "sync:<table>"
+        ttl: Seconds before an unreleased lease can be taken over
+        poll_interval: Seconds to wait between attempts
+    """
+    owner = uuid.uuid4().hex
+    while not _try_lease(key, owner, ttl):
+        time.sleep(poll_interval)
     try:
-        with open(SYNC_STATE_FILE, "r") as f:
-            return json.load(f)
-    except FileNotFoundError:
+        yield
+    finally:
+        with _db_lock:
+            _get_db().execute(
+                "DELETE FROM leases WHERE key = ? AND owner = ?", (key, owner)
+            )
+
+
+def _try_lease(key, owner, ttl):
+    now = time.time()
+    with _db_lock:
+        db = _get_db()
+        db.execute("DELETE FROM leases WHERE key = ? AND expires_at <= ?", (key, now))
+        cursor = db.execute(
+            "INSERT OR IGNORE INTO leases (key, owner, expires_at) VALUES (?, ?, ?)",
+            (key, owner, now + ttl),
+        )
+        return cursor.rowcount == 1
+
+
+def load_sync_state(table_name):
+    """
+    Load the last sync state of a table
+
+    Args:
+        table_name: Name of the table being synced
+
+    Returns:
+        dict: The saved state, or an empty dict if the table was never synced
+    """
+    with _db_lock:
+        row = (
+            _get_db()
+            .execute(
+                "SELECT db_hash, sheet_hash, last_sync, direction, db_signature "
+                "FROM sync_state WHERE table_name = ?",
+                (table_name,),
+            )
+            .fetchone()
+        )
+    if row is None:
         return {}
+    return dict(
+        zip(("db_hash", "sheet_hash", "last_sync", "direction", "db_signature"), row)
+    )
 
 
-def save_sync_state(table_name, db_hash, sheet_hash, timestamp, direction):
+def save_sync_state(
+    table_name, db_hash, sheet_hash, timestamp, direction, db_signature=None
+):
     """
     Save the current sync state
 
@@ -32,18 +217,82 @@ def save_sync_state(table_name, db_hash, sheet_hash, timestamp, direction):
         sheet_hash: Hash of the sheet data
         timestamp: Unix timestamp of the sync
         direction: Either "sheets_to_mysql" or "mysql_to_sheets"
+        db_signature: Cheap row count/checksum signature of the MySQL table
     """
-    state = load_sync_state()
-    state[table_name] = {
-        "db_hash": db_hash,
-        "sheet_hash": sheet_hash,
-        "last_sync": timestamp,
-        "direction": direction,
-    }
-    with open(SYNC_STATE_FILE, "w") as f:
-        json.dump(state, f, indent=2)
+    with _db_lock:
+        _get_db().execute(
+            """
+            INSERT INTO sync_state
+                (table_name, db_hash, sheet_hash, last_sync, direction, db_signature)
+            VALUES (?, ?, ?, ?, ?, ?)
+            ON CONFLICT(table_name) DO UPDATE SET
+                db_hash = excluded.db_hash,
+                sheet_hash = excluded.sheet_hash,
+                last_sync = excluded.last_sync,
+                direction = excluded.direction,
+                db_signature = excluded.db_signature
+            """,
+            (table_name, db_hash, sheet_hash, timestamp, direction, db_signature),
+        )
+
+
+def load_row_hashes(table_name):
+    """
+    Load the per-row hashes saved by the last Sheets → MySQL sync
+
+    Args:
+        table_name: Name of the table being synced
+
+    Returns:
+        list: One ROW_HASH_SIZE-byte digest per row, empty if none saved
+    """
+    with _db_lock:
+        row = (
+            _get_db()
+            .execute(
+                "SELECT hashes FROM row_hashes WHERE table_name = ?", (table_name,)
+            )
+            .fetchone()
+        )
+    if row is None or not row[0]:
+        return []
+    hashes = row[0]
+    return [hashes[i : i + ROW_HASH_SIZE] for i in range(0, len(hashes), ROW_HASH_SIZE)]
+
+
+def save_row_hashes(table_name, hashes):
+    """
+    Save the per-row hashes of the data just synced
+
+    Args:
+        table_name: Name of the table being synced
+        hashes: List of digests from get_row_hashes
+    """
+    with _db_lock:
+        _get_db().execute(
+            """
+            INSERT INTO row_hashes (table_name, hashes) VALUES (?, ?)
+            ON CONFLICT(table_name) DO UPDATE SET hashes = excluded.hashes
+            """,
+            (table_name, b"".join(hashes)),
+        )
+
+
+def get_row_hashes(data):
+    """Generate a short BLAKE2b digest per row for row-level change detection"""
+    return [
+        hashlib.blake2b(
+            "\x1f".join([("" if v is None else str(v)) for v in row]).encode(),
+            digest_size=ROW_HASH_SIZE,
+        ).digest()
+        for row in data
+    ]
 
 
 def get_data_hash(data):
-    """Generate MD5 hash of data for change detection"""
-    return hashlib.md5(json.dumps(data, sort_keys=True).encode()).hexdigest()
+    """Generate a BLAKE2b hash of data for change detection, one row at a time"""
+    h = hashlib.blake2b(digest_size=16)
+    for row in data:
+        h.update(b"\x1e".join([("" if v is None else str(v)).encode() for v in row]))
+        h.update(b"\x1f")
+    return h.hexdigest()